@@ -23,6 +23,7 @@ ZSCALER_STATE_FILE_CORRUPT_ERR = (
 )
 ZSCALER_MAX_PAGESIZE = 1000
 ZSCALER_DEFAULT_TIMEOUT = 30
+ZSCALER_MAX_RETRIES = 5
 
 # Constants relating to '_validate_integer'
 ZSCALER_VALID_INTEGER_MSG = "Please provide a valid integer value in the {param}"